@@ -1,125 +1,569 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
+import os
+import re
+import shutil
 import subprocess
 import sys
 import tempfile
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import (
+    TYPE_CHECKING, Awaitable, Dict, FrozenSet, List, Optional, TextIO, Tuple, Union
+)
 
-import requests
-from packaging.requirements import Requirement
-from packaging.specifiers import SpecifierSet
+# asyncio, requests, httpx and packaging are imported where they are used,
+# so that startup (e.g. --help) doesn't pay for them.
+if TYPE_CHECKING:
+    import httpx
+    import requests
 
+_READ_BUFFER_SIZE = 1 << 16
 
-def validate_requirements_file(file_path: str) -> bool:
-    """Validate that the file is a valid requirements file."""
+_ANCHOR_TEXT_RE = re.compile(r'>([^<]+)</a>')
+_SKIP_RE = re.compile(r'\s*(?:#|$)')
+# Editable installs, URLs and local paths, which no simple index serves. Each
+# needs an argument; a bare "-e" or "/" is left for Requirement() to reject.
+_DIRECT_REF_RE = re.compile(
+    r'(?:-e\s*|--editable(?:\s+|=)|https?:|git\+|file:|\.{0,2}/)\S'
+)
+# A bare project name with optional plain numeric version bounds. Anything
+# else (extras, markers, URLs, pre-releases, ...) goes through Requirement().
+_SIMPLE_REQ_RE = re.compile(
+    r'([A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)'
+    r'(?:\s*(?:==|!=|<=|>=|<|>)\s*[0-9]+(?:\.[0-9]+)*'
+    r'(?:\s*,\s*(?:==|!=|<=|>=|<|>)\s*[0-9]+(?:\.[0-9]+)*)*)?'
+)
+
+_CACHE_TTL = 3600
+
+# Upper bound on concurrent per-package probes, which also sizes the HTTP pools
+_MAX_CONNECTIONS = 64
+
+# Fetching an index's full project listing only pays off for enough names,
+# and is abandoned past a size that suggests a public index like pypi.org
+_LISTING_MIN_NAMES = 10
+_LISTING_MAX_BYTES = 4 << 20
+
+
+@lru_cache(maxsize=None)
+def _get_session() -> "requests.Session":
+    """Return the pooled requests session shared by all index lookups."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=_MAX_CONNECTIONS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def _get_httpx():
+    """Return the httpx module if it is installed with HTTP/2 support, else None."""
     try:
-        with open(file_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    Requirement(line)
+        import h2  # noqa: F401  (required by httpx for HTTP/2)
+        import httpx
+    except ImportError:
+        return None
+    return httpx
+
+
+def _parse_requirements(
+    input_file: Union[str, Path, TextIO]
+) -> Tuple[List[str], List[Tuple[int, str]], bool]:
+    """Parse the requirements in a single pass.
+
+    Returns the lines without terminators, the (line number, canonical
+    name) pairs of the requirements and whether every requirement line was
+    valid. The name is None for direct references, which are never looked
+    up in an index. Names are canonicalized here, once, and used as-is for
+    the listing lookup, the on-disk cache key and the probe URL.
+    """
+    if isinstance(input_file, (str, Path)):
+        with open(input_file, 'r', buffering=_READ_BUFFER_SIZE) as f:
+            return _parse_requirements(f)
+
+    from packaging.utils import canonicalize_name
+
+    lines = []
+    to_check = []
+    success = True
+
+    skip_line = _SKIP_RE.match
+    direct_ref = _DIRECT_REF_RE.match
+    simple_req = _SIMPLE_REQ_RE.fullmatch
+    for line in input_file:
+        # Blank and comment lines are passed through without parsing
+        if skip_line(line):
+            lines.append(line.rstrip('\r\n'))
+            continue
+
+        line = line.strip()
+        if direct_ref(line):
+            to_check.append((len(lines), None))
+            lines.append(line)
+            continue
+
+        match = simple_req(line)
+        if match:
+            name = canonicalize_name(match.group(1))
+        else:
+            from packaging.requirements import Requirement
+            try:
+                req = Requirement(line)
+            except Exception as e:
+                print(f"Error processing line '{line}': {e}", file=sys.stderr)
+                success = False
+                lines.append(line)
+                continue
+            # "name @ url" requirements are direct references too
+            name = None if req.url else canonicalize_name(req.name)
+        to_check.append((len(lines), name))
+        lines.append(line)
+
+    return lines, to_check, success
+
+
+def validate_requirements_file(file_path: Union[str, Path, TextIO]) -> bool:
+    """Validate that the file is a valid requirements file."""
+    return _parse_requirements(file_path)[2]
+
+
+def _project_status(status_code: int) -> Optional[bool]:
+    """Map a simple-index project page status to found, absent or unknown (None)."""
+    if status_code == 200:
         return True
-    except Exception as e:
-        print(f"Error validating requirements file: {e}", file=sys.stderr)
+    if status_code in (404, 410):
         return False
+    return None
 
 
 def check_package_in_index(package_name: str, index_url: str) -> bool:
     """Check if a package is available in the specified index."""
+    import requests
+    from packaging.utils import canonicalize_name
+
     try:
-        response = requests.get(f"{index_url}/{package_name}/")
-        return response.status_code == 200
+        return _check_package_in_index(canonicalize_name(package_name), index_url)
     except requests.RequestException:
         return False
 
 
+@lru_cache(maxsize=4096)
+def _check_package_in_index(package_name: str, index_url: str) -> bool:
+    """Query the index once per canonical package name and index URL.
+
+    Simple index project URLs use the PEP 503 normalized name, so the
+    canonical name is used as-is in the URL. Raises requests.RequestException
+    if the index gives no definite answer, so that failures aren't cached.
+    """
+    import requests
+
+    session = _get_session()
+    url = f"{index_url}/{package_name}/"
+    # Only the status code matters, so avoid downloading the file listing
+    response = session.head(url, allow_redirects=True, timeout=(5, 5))
+    if response.status_code == 405:
+        with session.get(url, stream=True, timeout=(5, 5)) as response:
+            pass
+    found = _project_status(response.status_code)
+    if found is None:
+        raise requests.HTTPError(
+            f"Unexpected status {response.status_code} for {url}", response=response
+        )
+    return found
+
+
+def _warn_unchecked(package_name: str, index_url: str, reason: str) -> None:
+    """Warn that a package's availability in an index could not be determined."""
+    print(f"Warning: could not check '{package_name}' in '{index_url}': {reason}",
+          file=sys.stderr)
+
+
+def _probe_package(package_name: str, index_url: str) -> Optional[bool]:
+    """Check a canonically named package, returning None if the check failed."""
+    import requests
+
+    try:
+        return _check_package_in_index(package_name, index_url)
+    except requests.RequestException as e:
+        _warn_unchecked(package_name, index_url, repr(e))
+        return None
+
+
+def _fetch_index_packages(index_url: str) -> Optional[FrozenSet[str]]:
+    """Fetch the canonical names of all projects listed on a simple index.
+
+    Returns None if the index does not serve a usable project listing: an
+    error response, a page without any project links, or a listing larger
+    than _LISTING_MAX_BYTES.
+    """
+    import requests
+    from packaging.utils import canonicalize_name
+
+    chunks = []
+    size = 0
+    try:
+        with _get_session().get(f"{index_url}/", stream=True, timeout=(5, 30)) as response:
+            if response.status_code != 200:
+                return None
+            for chunk in response.iter_content(chunk_size=_READ_BUFFER_SIZE):
+                size += len(chunk)
+                if size > _LISTING_MAX_BYTES:
+                    return None
+                chunks.append(chunk)
+            text = b''.join(chunks).decode(response.encoding or 'utf-8', errors='replace')
+    except requests.RequestException:
+        return None
+
+    names = frozenset(
+        canonicalize_name(name.strip()) for name in _ANCHOR_TEXT_RE.findall(text)
+    )
+    return names or None
+
+
+def _cache_path() -> Path:
+    """Return the path of the on-disk cache of index lookups.
+
+    The home directory is only looked up if XDG_CACHE_HOME is unset, and
+    raises RuntimeError if it can't be determined.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(cache_home) / 'analyze_deps' / 'index_cache.json'
+
+
+def _load_cache() -> Dict[str, Dict[str, List]]:
+    """Load the on-disk cache of index lookups, keyed by index URL then name."""
+    try:
+        with open(_cache_path(), 'r') as f:
+            cache = json.load(f)
+    except (OSError, RuntimeError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _cached_result(entry, now: float) -> Optional[bool]:
+    """Return a cache entry's answer, or None if it is malformed or expired."""
+    if not (isinstance(entry, list) and len(entry) == 2):
+        return None
+    found, timestamp = entry
+    if not isinstance(found, bool) or isinstance(timestamp, bool) \
+            or not isinstance(timestamp, (int, float)):
+        return None
+    return found if now - timestamp < _CACHE_TTL else None
+
+
+def _save_cache(cache: Dict[str, Dict[str, List]]) -> None:
+    """Atomically write the on-disk cache of index lookups."""
+    try:
+        cache_path = _cache_path()
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # A unique temporary file, so that concurrent runs don't collide
+        fd, temp_path = tempfile.mkstemp(
+            dir=cache_path.parent, prefix=f'.{cache_path.name}.', suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except (OSError, RuntimeError) as e:
+        print(f"Warning: could not write cache: {e}", file=sys.stderr)
+
+
+async def _check(
+    client: "httpx.AsyncClient",
+    package_name: str,
+    index_url: str
+) -> Optional[bool]:
+    """Asynchronously check if a canonically named package is in the specified index.
+
+    Returns None, after printing a warning, if the index could not be
+    queried or gave no definite answer, so that isn't mistaken for absence.
+    """
+    import httpx
+
+    url = f"{index_url}/{package_name}/"
+    try:
+        response = await client.head(url, follow_redirects=True)
+        if response.status_code == 405:
+            async with client.stream('GET', url, follow_redirects=True) as response:
+                pass
+    except httpx.HTTPError as e:
+        _warn_unchecked(package_name, index_url, repr(e))
+        return None
+
+    found = _project_status(response.status_code)
+    if found is None:
+        _warn_unchecked(package_name, index_url,
+                        f"unexpected status {response.status_code}")
+    return found
+
+
+async def _until_found(
+    checks: Dict[str, Awaitable[Optional[bool]]]
+) -> Dict[str, Optional[bool]]:
+    """Await the checks concurrently, cancelling the rest once one finds its package.
+
+    Returns the results of the checks that completed, keyed by name.
+    """
+    import asyncio
+
+    tasks = {asyncio.ensure_future(check): name for name, check in checks.items()}
+    results = {}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                results[tasks[task]] = task.result()
+            if any(results[tasks[task]] for task in done):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    return results
+
+
+async def _check_all(names: List[str], index_url: str) -> Dict[str, Optional[bool]]:
+    """Check canonically named packages concurrently until one is found.
+
+    Returns the results of the checks that completed, keyed by name; those
+    still running when a package is found are cancelled. A result is None
+    if that package could not be checked.
+    """
+    import asyncio
+
+    httpx = _get_httpx()
+    if httpx is None:
+        # Without httpx, run the blocking probes on worker threads; they
+        # share the pooled session, whose pool is sized for this many. The
+        # names are already canonical, so skip the public wrapper.
+        from concurrent.futures import ThreadPoolExecutor
+
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=_MAX_CONNECTIONS)
+        try:
+            return await _until_found({
+                name: loop.run_in_executor(executor, _probe_package, name, index_url)
+                for name in names
+            })
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    # HTTP/2 multiplexes every probe over a single connection. Probes beyond
+    # the pool size wait on the semaphore rather than in the pool, so time
+    # spent queued never counts against a request timeout.
+    limits = httpx.Limits(
+        max_connections=_MAX_CONNECTIONS, max_keepalive_connections=32
+    )
+    timeout = httpx.Timeout(5.0, pool=None)
+    semaphore = asyncio.Semaphore(_MAX_CONNECTIONS)
+
+    async def bounded_check(client, name):
+        async with semaphore:
+            return await _check(client, name, index_url)
+
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout) as client:
+        return await _until_found({name: bounded_check(client, name) for name in names})
+
+
+async def _process_async(
+    input_file: Union[str, Path, TextIO],
+    preferred_index: Optional[str],
+    use_cache: bool = False
+) -> Tuple[List[str], bool, bool]:
+    """Find whether the preferred index serves any of the requirements.
+
+    Returns the parsed lines, whether any requirement was found in the
+    preferred index and whether every requirement line was valid. Lookups
+    stop at the first package found, since one is enough.
+    """
+    lines, to_check, success = _parse_requirements(input_file)
+
+    # Probe each distinct project once, however many times it is listed.
+    # An invalid file is rejected anyway, so don't spend requests on it.
+    names = list(dict.fromkeys(name for _, name in to_check if name))
+    found = False
+    if preferred_index and names and success:
+        now = time.time()
+        cache = _load_cache() if use_cache else {}
+        # Anything malformed in the cache is treated as a miss
+        entries = cache.get(preferred_index)
+        if not isinstance(entries, dict):
+            entries = cache[preferred_index] = {}
+        cached = {}
+        for name in names:
+            result = _cached_result(entries.get(name), now)
+            if result is not None:
+                cached[name] = result
+        found = any(cached.values())
+        missing = [name for name in names if name not in cached]
+
+        if missing and not found:
+            # For more than a few packages, one request for the whole project
+            # listing beats one per package; fall back to probing individually
+            # if the index has no usable listing.
+            available = None
+            if len(missing) >= _LISTING_MIN_NAMES:
+                available = _fetch_index_packages(preferred_index)
+            if available is None:
+                results = await _check_all(missing, preferred_index)
+            else:
+                results = {name: name in available for name in missing}
+            found = any(results.values())
+
+            # Only persist definite answers; a failed check is retried next run
+            if use_cache:
+                entries.update(
+                    (name, [result, now]) for name, result in results.items()
+                    if result is not None
+                )
+                _save_cache(cache)
+
+    return lines, found, success
+
+
 def process_requirements_file(
-    input_file: str,
+    input_file: Union[str, Path, TextIO],
     preferred_index: Optional[str],
-    default_index: str
-) -> Tuple[str, bool]:
-    """Process the requirements file and return the updated content."""
-    updated_lines = []
-    success = True
+    output: TextIO,
+    use_cache: bool = False
+) -> Tuple[bool, bool]:
+    """Process the requirements file, writing the requirements to output.
 
-    with open(input_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                updated_lines.append(line)
-                continue
+    Requirements are written as-is; index selection is left to
+    pip-compile. Returns whether every requirement line was valid and
+    whether the preferred index serves any of the requirements. With
+    use_cache, preferred-index lookups are persisted on disk and reused
+    across runs for an hour.
+    """
+    import asyncio
 
-            try:
-                req = Requirement(line)
-                package_name = req.name
+    lines, found, success = asyncio.run(
+        _process_async(input_file, preferred_index, use_cache)
+    )
+    output.writelines(f"{line}\n" for line in lines)
+    return success, found
 
-                if preferred_index and check_package_in_index(package_name, preferred_index):
-                    updated_lines.append(f"{line} --index-url {preferred_index}")
-                else:
-                    updated_lines.append(f"{line} --index-url {default_index}")
-            except Exception as e:
-                print(f"Error processing line '{line}': {e}", file=sys.stderr)
-                success = False
-                updated_lines.append(line)
 
-    return '\n'.join(updated_lines), success
+def _run_pip_compile(command: List[str], output_path: Optional[str]) -> bool:
+    """Run pip-compile, streaming its output to the terminal and output_path.
+
+    The output is written to a temporary file next to output_path, which
+    only replaces it once pip-compile succeeds, so a failed run never
+    clobbers an existing lockfile. Returns whether pip-compile succeeded.
+    """
+    output_file = None
+    if output_path:
+        target = Path(output_path)
+        output_file = tempfile.NamedTemporaryFile(
+            mode='w', dir=target.resolve().parent, prefix=f".{target.name}.",
+            suffix='.tmp', delete=False
+        )
+
+    try:
+        # stderr is collected in a file so a chatty pip-compile can't fill
+        # the pipe and stall
+        with tempfile.TemporaryFile(mode='w+') as stderr_file:
+            with subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+                text=True,
+                bufsize=1
+            ) as process:
+                for line in process.stdout:
+                    sys.stdout.write(line)
+                    if output_file:
+                        output_file.write(line)
+
+            if process.returncode != 0:
+                stderr_file.seek(0)
+                print(f"Error running pip-compile: {stderr_file.read()}", file=sys.stderr)
+                return False
+
+        if output_file:
+            output_file.close()
+            # Keep the permissions an existing file had, or that open() would give
+            try:
+                shutil.copymode(output_path, output_file.name)
+            except FileNotFoundError:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(output_file.name, 0o666 & ~umask)
+            os.replace(output_file.name, output_path)
+            output_file = None
+        return True
+    finally:
+        if output_file:
+            output_file.close()
+            Path(output_file.name).unlink()
 
 
 def main():
     parser = argparse.ArgumentParser(description='Analyze Python dependencies and generate hashes.')
     parser.add_argument('input_file', help='Input requirements file')
     parser.add_argument('-o', '--output', help='Output file path')
-    parser.add_argument('-p', '--preferred-index', help='Preferred PyPI index URL')
+    parser.add_argument('-p', '--preferred-index',
+                       help='Additional PyPI index URL, used if it serves any requirement; '
+                            'it gets no precedence over the default index')
     parser.add_argument('-d', '--default-index', 
                        default='https://pypi.org/simple',
                        help='Default PyPI index URL (default: https://pypi.org/simple)')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Do not read or write the on-disk index lookup cache')
 
     args = parser.parse_args()
 
-    # Validate input file
-    if not Path(args.input_file).exists():
+    # Open input file; failing here replaces a separate existence check
+    try:
+        input_file = open(args.input_file, 'r', buffering=_READ_BUFFER_SIZE)
+    except FileNotFoundError:
         print(f"Error: Input file '{args.input_file}' does not exist.", file=sys.stderr)
         sys.exit(1)
-
-    if not validate_requirements_file(args.input_file):
+    except OSError as e:
+        print(f"Error: Cannot read input file '{args.input_file}': {e}", file=sys.stderr)
         sys.exit(1)
 
-    # Process requirements file
-    updated_content, success = process_requirements_file(
-        args.input_file,
-        args.preferred_index,
-        args.default_index
-    )
-
-    if not success:
-        sys.exit(1)
-
-    # Create temporary file with updated requirements
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as temp_file:
-        temp_file.write(updated_content)
-        temp_file_path = temp_file.name
+    temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False)
+    temp_file_path = temp_file.name
 
     try:
-        # Run pip-compile with --generate-hashes
-        result = subprocess.run(
-            ['pip-compile', '--generate-hashes', temp_file_path],
-            capture_output=True,
-            text=True
-        )
+        # Validate and process requirements file in a single pass, writing the
+        # requirements straight to the temporary file
+        with input_file, temp_file:
+            success, use_preferred = process_requirements_file(
+                input_file,
+                args.preferred_index,
+                temp_file,
+                use_cache=not args.no_cache
+            )
 
-        if result.returncode != 0:
-            print(f"Error running pip-compile: {result.stderr}", file=sys.stderr)
+        if not success:
             sys.exit(1)
 
-        # Print output to terminal
-        print(result.stdout)
+        # Resolve everything in one pip-compile run against the default
+        # index, adding the preferred index only if it serves any of the
+        # requirements. pip treats extra indexes as equals, so the preferred
+        # index takes no precedence: each package comes from whichever
+        # index has the best matching version.
+        command = ['pip-compile', '--generate-hashes', '--output-file=-',
+                   '--index-url', args.default_index]
+        if use_preferred:
+            command += ['--extra-index-url', args.preferred_index]
+        command.append(temp_file_path)
 
-        # Write to output file if specified
-        if args.output:
-            with open(args.output, 'w') as f:
-                f.write(result.stdout)
+        if not _run_pip_compile(command, args.output):
+            sys.exit(1)
 
     finally:
         # Clean up temporary file
@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
+import asyncio
+import io
 import os
 import tempfile
 import unittest
 from pathlib import Path
 from unittest.mock import patch, MagicMock
 
+import vcr
+
 from analyze_deps import (
+    _check_all,
+    _check_package_in_index,
+    _fetch_index_packages,
+    _get_httpx,
     validate_requirements_file,
     check_package_in_index,
+    main,
     process_requirements_file,
 )
 
@@ -18,6 +27,7 @@ class TestAnalyzeDeps(unittest.TestCase):
         self.test_requirements = "test_requirements.txt"
         self.preferred_index = "https://console.redhat.com/api/pulp-content/public-calunga/mypypi/simple"
         self.default_index = "https://pypi.org/simple"
+        _check_package_in_index.cache_clear()
 
     def test_validate_requirements_file(self):
         """Test requirements file validation."""
@@ -34,9 +44,40 @@ class TestAnalyzeDeps(unittest.TestCase):
         finally:
             os.unlink(temp_file_path)
 
-    @patch('analyze_deps.requests.get')
-    def test_check_package_in_index(self, mock_get):
+    def test_validate_requirements_forms(self):
+        """Test simple and complex requirement lines are validated alike."""
+        valid = (
+            "requests",
+            "requests>=2.31.0,<3",
+            "Django[bcrypt]>=4.2; python_version >= '3.8'",
+            "pip @ https://github.com/pypa/pip/archive/22.0.2.zip",
+            "urllib3~=2.0",
+            "numpy>=2.0.0rc1",
+            "-e .",
+            "--editable ./src/package",
+            "git+https://github.com/pypa/pip.git@22.0.2",
+        )
+        invalid = (
+            "requests>=>2",
+            "requests==",
+            "requests 2.0",
+            "urllib3~=2",
+            "-e",
+            "--editable",
+            "/",
+            "https:",
+        )
+
+        for line in valid:
+            self.assertTrue(validate_requirements_file(io.StringIO(line)), line)
+        for line in invalid:
+            self.assertFalse(validate_requirements_file(io.StringIO(line)), line)
+
+    @patch('analyze_deps._get_session')
+    def test_check_package_in_index(self, mock_session):
         """Test package availability checking in index."""
+        mock_get = mock_session.return_value.head
+
         # Mock successful response for urllib3
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -52,38 +93,456 @@ class TestAnalyzeDeps(unittest.TestCase):
         # Test requests not in preferred index
         self.assertFalse(check_package_in_index("requests", self.preferred_index))
 
-    @patch('analyze_deps.check_package_in_index')
-    def test_process_requirements_file(self, mock_check_package):
+    @patch('analyze_deps._get_session')
+    def test_check_package_in_index_head_not_allowed(self, mock_session):
+        """Test falling back to a streamed GET when the index rejects HEAD."""
+        mock_head = mock_session.return_value.head
+        mock_get = mock_session.return_value.get
+        mock_head.return_value = MagicMock(status_code=405)
+        mock_get.return_value.__enter__.return_value = MagicMock(status_code=200)
+
+        self.assertTrue(check_package_in_index("urllib3", self.preferred_index))
+        mock_get.assert_called_once_with(
+            f"{self.preferred_index}/urllib3/", stream=True, timeout=(5, 5)
+        )
+
+    @patch('analyze_deps._get_session')
+    def test_check_package_in_index_failures_not_cached(self, mock_session):
+        """Test failed lookups are retried rather than remembered as absent."""
+        import requests
+
+        mock_head = mock_session.return_value.head
+        mock_head.side_effect = requests.ConnectionError("network is unreachable")
+        self.assertFalse(check_package_in_index("urllib3", self.preferred_index))
+
+        mock_head.side_effect = None
+        mock_head.return_value = MagicMock(status_code=503)
+        self.assertFalse(check_package_in_index("urllib3", self.preferred_index))
+
+        mock_head.return_value = MagicMock(status_code=200)
+        self.assertTrue(check_package_in_index("urllib3", self.preferred_index))
+        self.assertEqual(mock_head.call_count, 3)
+
+    @patch('analyze_deps._get_session')
+    def test_check_package_in_index_cached(self, mock_session):
+        """Test repeated lookups of the same project hit the index once."""
+        mock_get = mock_session.return_value.head
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_get.return_value = mock_response
+
+        for name in ("Flask", "flask", "FLASK"):
+            self.assertTrue(check_package_in_index(name, self.preferred_index))
+
+        mock_get.assert_called_once_with(
+            f"{self.preferred_index}/flask/", allow_redirects=True, timeout=(5, 5)
+        )
+
+    @unittest.skipIf(_get_httpx() is None, "httpx[http2] is not installed")
+    def test_check_all_transport_error(self):
+        """Test a failed probe is reported as unknown rather than absent."""
+        httpx = _get_httpx()
+        async_client = httpx.AsyncClient
+
+        def handler(request):
+            if request.url.path.endswith('/broken/'):
+                raise httpx.ConnectError("connection refused", request=request)
+            return httpx.Response(200 if request.url.path.endswith('/urllib3/') else 404)
+
+        def mock_client(**kwargs):
+            return async_client(transport=httpx.MockTransport(handler), **kwargs)
+
+        with patch.object(httpx, 'AsyncClient', mock_client), \
+                patch('sys.stderr', io.StringIO()) as stderr:
+            results = asyncio.run(
+                _check_all(["requests", "broken"], self.preferred_index)
+            )
+
+        self.assertEqual(results, {"requests": False, "broken": None})
+        self.assertIn("could not check 'broken'", stderr.getvalue())
+
+    def test_check_all_stops_when_found(self):
+        """Test outstanding checks are cancelled once a package is found."""
+        httpx = _get_httpx()
+        async_client = httpx.AsyncClient
+
+        async def handler(request):
+            if not request.url.path.endswith('/urllib3/'):
+                await asyncio.sleep(60)
+            return httpx.Response(200)
+
+        def mock_client(**kwargs):
+            return async_client(transport=httpx.MockTransport(handler), **kwargs)
+
+        with patch.object(httpx, 'AsyncClient', mock_client):
+            results = asyncio.run(asyncio.wait_for(
+                _check_all(["requests", "urllib3", "six"], self.preferred_index), 10
+            ))
+
+        self.assertEqual(results, {"urllib3": True})
+
+    @patch('analyze_deps._get_session')
+    def test_fetch_index_packages(self, mock_session):
+        """Test parsing the project listing of a simple index."""
+        mock_response = mock_session.return_value.get.return_value.__enter__.return_value
+        mock_response.status_code = 200
+        mock_response.encoding = 'utf-8'
+        mock_response.iter_content.return_value = [
+            b'<html><body>\n<a href="/simple/urllib3/">urllib3</a>\n',
+            b'<a href="/simple/zope-interface/">zope.interface</a>\n</body></html>',
+        ]
+
+        self.assertEqual(
+            _fetch_index_packages(self.preferred_index),
+            frozenset({"urllib3", "zope-interface"})
+        )
+
+        # Oversized listings are abandoned
+        with patch('analyze_deps._LISTING_MAX_BYTES', 64):
+            self.assertIsNone(_fetch_index_packages(self.preferred_index))
+
+        # Pages without project links aren't taken as an empty index
+        mock_response.iter_content.return_value = [b'{"projects": []}']
+        self.assertIsNone(_fetch_index_packages(self.preferred_index))
+
+        # Indexes without a listing signal a fallback to per-package checks
+        mock_response.status_code = 404
+        self.assertIsNone(_fetch_index_packages(self.preferred_index))
+
+    @patch('analyze_deps._check')
+    @patch('analyze_deps._fetch_index_packages', return_value=None)
+    def test_process_requirements_file(self, mock_fetch_packages, mock_check_package):
         """Test requirements file processing."""
         # Mock package availability
-        def mock_check(package_name, index_url):
+        def mock_check(client, package_name, index_url):
             return package_name == "urllib3"
 
         mock_check_package.side_effect = mock_check
 
         # Process the requirements file
-        updated_content, success = process_requirements_file(
+        output = io.StringIO()
+        success, found = process_requirements_file(
             self.test_requirements,
             self.preferred_index,
-            self.default_index
+            output
         )
+        updated_content = output.getvalue()
 
         self.assertTrue(success)
-        
-        # Split content into lines and check each package
-        lines = updated_content.split('\n')
-        for line in lines:
-            if not line or line.startswith('#'):
-                continue
-            
-            if 'urllib3' in line:
-                self.assertIn(f"--index-url {self.preferred_index}", line)
-            elif 'requests' in line:
-                self.assertIn(f"--index-url {self.default_index}", line)
+        self.assertTrue(found)
+
+        # Requirements are written without per-line index options
+        self.assertEqual(updated_content, "requests>=2.31.0\nurllib3>=2.0.0\n")
+
+    @patch('analyze_deps._get_httpx', return_value=None)
+    @patch('analyze_deps._get_session')
+    @patch('analyze_deps._fetch_index_packages', return_value=None)
+    def test_process_requirements_file_threaded(self, mock_fetch_packages, mock_session, mock_httpx):
+        """Test per-package checks run on threads when httpx is unavailable."""
+        mock_head = mock_session.return_value.head
+
+        mock_head.return_value = MagicMock(status_code=404)
+
+        output = io.StringIO()
+        success, found = process_requirements_file(
+            io.StringIO("requests>=2.31.0\nurllib3>=2.0.0\nsix\n"),
+            self.preferred_index,
+            output
+        )
+        updated_content = output.getvalue()
+
+        self.assertTrue(success)
+        self.assertFalse(found)
+        self.assertEqual(updated_content, "requests>=2.31.0\nurllib3>=2.0.0\nsix\n")
+        self.assertEqual(mock_head.call_count, 3)
+
+        def mock_check(url, **kwargs):
+            return MagicMock(status_code=200 if '/urllib3/' in url else 404)
+
+        mock_head.side_effect = mock_check
+        _check_package_in_index.cache_clear()
+        success, found = process_requirements_file(
+            io.StringIO("requests>=2.31.0\nurllib3>=2.0.0\nsix\n"),
+            self.preferred_index,
+            io.StringIO()
+        )
+        self.assertTrue(found)
+
+    @patch('analyze_deps._check')
+    @patch('analyze_deps._fetch_index_packages')
+    def test_process_requirements_file_object(self, mock_fetch_packages, mock_check_package):
+        """Test processing an open file validates and rewrites in one pass."""
+        mock_check_package.return_value = False
+
+        output = io.StringIO()
+        success, found = process_requirements_file(
+            io.StringIO("# pinned\n\n  \t\n  requests>=2.31.0  \n"),
+            self.preferred_index,
+            output
+        )
+        updated_content = output.getvalue()
+
+        self.assertTrue(success)
+        self.assertFalse(found)
+        self.assertEqual(updated_content, "# pinned\n\n  \t\nrequests>=2.31.0\n")
 
+        # A single package is probed directly, without fetching the listing
+        mock_fetch_packages.assert_not_called()
+        mock_check_package.assert_called_once()
+
+        # Invalid lines are reported and no requests are made
+        mock_check_package.reset_mock()
+        success, found = process_requirements_file(
+            io.StringIO("requests>=2.31.0\npackage name with spaces @ version\n"),
+            self.preferred_index,
+            io.StringIO()
+        )
+
+        self.assertFalse(success)
+        mock_fetch_packages.assert_not_called()
+        mock_check_package.assert_not_called()
+
+    @patch('analyze_deps._check')
+    @patch('analyze_deps._fetch_index_packages')
+    def test_process_requirements_file_direct_references(self, mock_fetch_packages, mock_check_package):
+        """Test editable, URL and path requirements skip the preferred index."""
+        direct_refs = [
+            "-e .",
+            "--editable=./src/package",
+            "git+https://github.com/pypa/pip.git@22.0.2",
+            "https://example.com/pkg-1.0.tar.gz",
+            "file:///tmp/pkg-1.0.tar.gz",
+            "../pkg",
+            "/opt/wheels/pkg-1.0-py3-none-any.whl",
+            "pip @ https://github.com/pypa/pip/archive/22.0.2.zip",
+        ]
+
+        output = io.StringIO()
+        success, found = process_requirements_file(
+            io.StringIO("\n".join(direct_refs)),
+            self.preferred_index,
+            output
+        )
+
+        self.assertTrue(success)
+        self.assertFalse(found)
+        self.assertEqual(output.getvalue().splitlines(), direct_refs)
+        mock_fetch_packages.assert_not_called()
+        mock_check_package.assert_not_called()
+
+    @patch('analyze_deps._check')
+    @patch('analyze_deps._fetch_index_packages')
+    def test_process_requirements_file_listing(self, mock_fetch_packages, mock_check_package):
+        """Test many packages are matched against the index's project listing."""
+        mock_fetch_packages.return_value = frozenset({"urllib3", "zope-interface"})
+        names = ["urllib3", "Zope.Interface"] + [f"package{i}" for i in range(10)]
+
+        success, found = process_requirements_file(
+            io.StringIO("\n".join(names)),
+            self.preferred_index,
+            io.StringIO()
+        )
+
+        self.assertTrue(success)
+        self.assertTrue(found)
+        mock_fetch_packages.assert_called_once_with(self.preferred_index)
+        mock_check_package.assert_not_called()
+
+        # Without a usable listing every package is probed instead
+        mock_fetch_packages.return_value = None
+        mock_check_package.return_value = False
+
+        success, found = process_requirements_file(
+            io.StringIO("\n".join(names)),
+            self.preferred_index,
+            io.StringIO()
+        )
+
+        self.assertFalse(found)
+        self.assertEqual(mock_check_package.call_count, len(names))
+
+    @patch('analyze_deps._check')
+    def test_process_requirements_file_cache(self, mock_check_package):
+        """Test index lookups are reused from the on-disk cache."""
+        mock_check_package.side_effect = lambda client, name, index_url: name == "urllib3"
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir}):
+            for _ in range(2):
+                output = io.StringIO()
+                success, found = process_requirements_file(
+                    self.test_requirements,
+                    self.preferred_index,
+                    output,
+                    use_cache=True
+                )
+                self.assertTrue(success)
+                self.assertTrue(found)
+
+            self.assertEqual(mock_check_package.call_count, 2)
+
+            # Expired entries are looked up again
+            with patch('analyze_deps._CACHE_TTL', 0):
+                process_requirements_file(
+                    self.test_requirements,
+                    self.preferred_index,
+                    io.StringIO(),
+                    use_cache=True
+                )
+            self.assertEqual(mock_check_package.call_count, 4)
+
+    @patch('analyze_deps._check')
+    def test_process_requirements_file_cache_malformed(self, mock_check_package):
+        """Test malformed cache contents are treated as misses and replaced."""
+        import json
+
+        mock_check_package.side_effect = lambda client, name, index_url: name == "urllib3"
+
+        corrupt = (
+            ["x"],
+            {"urllib3": 5, "requests": ["x", 0]},
+            {"urllib3": [True], "requests": [False, True]},
+        )
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir}):
+            cache_path = Path(cache_dir) / 'analyze_deps' / 'index_cache.json'
+            cache_path.parent.mkdir()
+            for entries in corrupt:
+                mock_check_package.reset_mock()
+                cache_path.write_text(json.dumps({self.preferred_index: entries}))
+
+                success, found = process_requirements_file(
+                    self.test_requirements,
+                    self.preferred_index,
+                    io.StringIO(),
+                    use_cache=True
+                )
+
+                self.assertTrue(found)
+                self.assertEqual(mock_check_package.call_count, 2)
+
+            self.assertEqual(os.listdir(cache_path.parent), ['index_cache.json'])
+
+    @patch('analyze_deps._check')
+    def test_process_requirements_file_cache_without_home(self, mock_check_package):
+        """Test a missing home directory disables the cache with a warning."""
+        mock_check_package.side_effect = lambda client, name, index_url: name == "urllib3"
+
+        environ = {k: v for k, v in os.environ.items() if k != 'XDG_CACHE_HOME'}
+        with patch.dict(os.environ, environ, clear=True), \
+                patch('analyze_deps.Path.home',
+                      side_effect=RuntimeError("Could not determine home directory")), \
+                patch('sys.stderr', io.StringIO()) as stderr:
+            success, found = process_requirements_file(
+                self.test_requirements,
+                self.preferred_index,
+                io.StringIO(),
+                use_cache=True
+            )
+
+        self.assertTrue(success)
+        self.assertTrue(found)
+        self.assertIn("could not write cache", stderr.getvalue())
+
+    @patch('analyze_deps._get_httpx', return_value=None)
+    @patch('analyze_deps._get_session')
+    def test_process_requirements_file_cache_skips_failures(self, mock_session, mock_httpx):
+        """Test lookups that failed on the network aren't cached as absent."""
+        import requests
+
+        mock_head = mock_session.return_value.head
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch.dict(os.environ, {'XDG_CACHE_HOME': cache_dir}), \
+                patch('sys.stderr', io.StringIO()):
+            mock_head.side_effect = requests.ConnectionError("network is unreachable")
+            success, found = process_requirements_file(
+                io.StringIO("urllib3>=2.0.0\n"),
+                self.preferred_index,
+                io.StringIO(),
+                use_cache=True
+            )
+            self.assertTrue(success)
+            self.assertFalse(found)
+
+            # With the network back, the package is found
+            mock_head.side_effect = None
+            mock_head.return_value = MagicMock(status_code=200)
+            success, found = process_requirements_file(
+                io.StringIO("urllib3>=2.0.0\n"),
+                self.preferred_index,
+                io.StringIO(),
+                use_cache=True
+            )
+            self.assertTrue(found)
+
+    @patch('analyze_deps.subprocess.Popen')
+    @patch('analyze_deps._check')
+    def test_main_index_options(self, mock_check_package, mock_popen):
+        """Test pip-compile gets the preferred index only when it is needed."""
+        process = mock_popen.return_value.__enter__.return_value
+        process.returncode = 0
+
+        for available, extra_index in ((frozenset({"urllib3"}), True), (frozenset(), False)):
+            mock_check_package.side_effect = lambda client, name, index_url: name in available
+            argv = ['analyze_deps.py', self.test_requirements, '--no-cache',
+                    '-p', self.preferred_index, '-d', self.default_index]
+            process.stdout = iter(["urllib3==2.0.0\n"])
+
+            with patch('sys.argv', argv), patch('sys.stdout', io.StringIO()):
+                main()
+
+            command = mock_popen.call_args[0][0]
+            self.assertEqual(command[:5], [
+                'pip-compile', '--generate-hashes', '--output-file=-',
+                '--index-url', self.default_index,
+            ])
+            self.assertEqual(
+                command[5:-1],
+                ['--extra-index-url', self.preferred_index] if extra_index else []
+            )
+
+    @patch('analyze_deps.subprocess.Popen')
+    def test_main_output_file(self, mock_popen):
+        """Test the output file is only replaced when pip-compile succeeds."""
+        process = mock_popen.return_value.__enter__.return_value
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_path = Path(output_dir) / 'out.txt'
+            output_path.write_text("GOOD LOCKFILE\n")
+            argv = ['analyze_deps.py', self.test_requirements, '-o', str(output_path)]
+
+            process.stdout = iter(["partial line\n"])
+            process.returncode = 1
+            with patch('sys.argv', argv), patch('sys.stdout', io.StringIO()), \
+                    patch('sys.stderr', io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    main()
+            self.assertEqual(output_path.read_text(), "GOOD LOCKFILE\n")
+            self.assertEqual(os.listdir(output_dir), ['out.txt'])
+
+            process.stdout = iter(["urllib3==2.0.0\n"])
+            process.returncode = 0
+            with patch('sys.argv', argv), patch('sys.stdout', io.StringIO()):
+                main()
+            self.assertEqual(output_path.read_text(), "urllib3==2.0.0\n")
+            self.assertEqual(os.listdir(output_dir), ['out.txt'])
+
+    @patch('analyze_deps.process_requirements_file', side_effect=UnicodeDecodeError(
+        'utf-8', b'\xff', 0, 1, 'invalid start byte'))
+    def test_main_cleans_up_on_error(self, mock_process):
+        """Test the temporary requirements file is removed if processing fails."""
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                patch('tempfile.tempdir', temp_dir), \
+                patch('sys.argv', ['analyze_deps.py', self.test_requirements]):
+            with self.assertRaises(UnicodeDecodeError):
+                main()
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    @vcr.use_cassette('fixtures/end_to_end.yaml', allow_playback_repeats=True)
     def test_end_to_end(self):
-        """Test the complete workflow with actual file processing."""
-        # First verify that urllib3 is actually available in the preferred index
+        """Test the complete workflow against canned index responses."""
+        # First verify that urllib3 is available in the preferred index
         self.assertTrue(check_package_in_index("urllib3", self.preferred_index),
                        "urllib3 should be available in the preferred index")
         
@@ -97,21 +556,19 @@ class TestAnalyzeDeps(unittest.TestCase):
 
         try:
             # Process the temporary file
-            updated_content, success = process_requirements_file(
+            output = io.StringIO()
+            success, found = process_requirements_file(
                 temp_file_path,
                 self.preferred_index,
-                self.default_index
+                output
             )
 
             self.assertTrue(success)
-            
-            # Verify the output
-            lines = updated_content.split('\n')
-            urllib3_line = next(line for line in lines if 'urllib3' in line)
-            requests_line = next(line for line in lines if 'requests' in line)
-
-            self.assertIn(f"--index-url {self.preferred_index}", urllib3_line)
-            self.assertIn(f"--index-url {self.default_index}", requests_line)
+
+            # urllib3 is found in the preferred index, which is enough to pass
+            # that index to pip-compile as an extra index
+            self.assertTrue(found)
+            self.assertEqual(output.getvalue(), "requests>=2.31.0\nurllib3>=2.0.0\n")
 
         finally:
             os.unlink(temp_file_path)